@@ -3,10 +3,38 @@
 import pandas as pd
 import seaborn as sns
 import numpy as np
+import matplotlib
+# Non-interactive backend so figures can be rendered in worker processes
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import argparse
+import hashlib
 import os
 import pathlib
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import pdist
+try:
+    import fastcluster
+except ImportError:
+    fastcluster = None
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+except ImportError:
+    pa = None
+
+# Labels in the superkingdom column matched by each superkingdom option
+SUPERKINGDOM_LABELS = {
+    "Virus": ['sk__Viruses', 'Viruses'],
+    "Bacteria": ['sk__Bacteria', 'Bacteria'],
+}
+
+# Largest number of leaves a dendrogram is optimally leaf ordered for. The
+# ordering is O(n^3) worst case, but quick at the sizes heatmaps show.
+OPTIMAL_ORDERING_MAX_LEAVES = 256
 
 def str2bool(v):
     """
@@ -22,75 +50,170 @@ def str2bool(v):
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
-def generate_heatmap(df,
+def read_hit_table(input_df, index_col, category_cols, non_sample_cols):
+    """
+    Reads the tab-delimited hit table, keeping only index_col, category_cols
+    and the sample columns (everything not in non_sample_cols). The header is
+    read first so the other columns are never parsed. Sample columns are
+    parsed as float32 and category_cols as categoricals. Uses pyarrow's
+    multithreaded reader when available, else pandas' C engine.
+    """
+    header = pd.read_csv(input_df, sep="\t", nrows=0).columns
+    is_sample = ~header.isin(frozenset(non_sample_cols) | {index_col})
+    sample_cols = header[is_sample].to_list()
+    usecols = header[is_sample | header.isin([index_col] + category_cols)].to_list()
+
+    if pa is not None:
+        column_types = {col: pa.float32() for col in sample_cols}
+        column_types.update({col: pa.dictionary(pa.int32(), pa.string()) for col in category_cols})
+        column_types[index_col] = pa.string()
+        table = pacsv.read_csv(input_df,
+                               parse_options=pacsv.ParseOptions(delimiter="\t"),
+                               convert_options=pacsv.ConvertOptions(column_types=column_types,
+                                                                    include_columns=usecols)
+                               )
+        df = table.to_pandas()
+    else:
+        dtypes = {col: np.float32 for col in sample_cols}
+        dtypes.update({col: 'category' for col in category_cols})
+        df = pd.read_csv(input_df,
+                         sep="\t",
+                         index_col=False,
+                         usecols=usecols,
+                         dtype=dtypes,
+                         engine='c',
+                         memory_map=True
+                         )
+    return df.set_index(index_col)
+
+def hit_table_cache_path(cache_dir, input_df, input_format, remove_suffix):
+    """
+    Path of the parquet cache for a parsed hit table. The name is a hash of the
+    input's path, modification time and size plus the options that change
+    the parsed table, so editing the input or options misses the cache.
+    """
+    stat = os.stat(input_df)
+    key = "\t".join([os.path.abspath(input_df),
+                     str(stat.st_mtime_ns),
+                     str(stat.st_size),
+                     input_format.lower(),
+                     remove_suffix])
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".parquet")
+
+def compute_linkage(data, metric='euclidean', method='average'):
+    """
+    Returns the linkage of the rows of data, using the same defaults as
+    seaborn's clustermap. The condensed pairwise distances are computed once
+    and used for both the linkage and the leaf ordering. Small linkages are
+    optimally leaf ordered, so similar rows end up next to each other in the
+    heatmap.
+    """
+    distances = pdist(np.asarray(data, dtype=np.float32), metric=metric)
+    # fastcluster's C++ linkage is a drop-in replacement for scipy's, fall
+    # back to scipy if it isn't installed
+    if fastcluster is not None:
+        linkage = fastcluster.linkage(distances, method=method)
+    else:
+        linkage = hierarchy.linkage(distances, method=method)
+    if len(data) <= OPTIMAL_ORDERING_MAX_LEAVES:
+        linkage = hierarchy.optimal_leaf_ordering(linkage, distances)
+    return linkage
+
+def top_log10(mat, k):
+    """
+    Picks the k rows of mat with the highest mean (highest first), takes log10
+    of them with zero counts left at 0, and flags the columns that are not
+    all 0. Returns (top row indices, logged rows, column keep mask).
+    """
+    # Means accumulate in float64 so float32 rounding cannot reorder close
+    # rows. Ties keep the row order of the table.
+    top_idx = pd.Series(mat.mean(axis=1, dtype=np.float64)).nlargest(k).index.to_numpy()
+    counts = mat[top_idx]
+    logged = np.log10(counts, out=np.zeros_like(counts), where=counts > 0)
+    return top_idx, logged, logged.any(axis=0)
+
+def print_empty_notice(level, superkingdom):
+    print("The dataframe is of size zero.")
+    print("There may be no taxa of the superkingdom, or no taxa of the given level.")
+    print("level: {0}, superkingdom:{1}".format(level, superkingdom))
+
+def generate_heatmap(level_df,
+    sample_cols,
     level,
-    non_sample_cols,
     TOP_NUMBER_OF_ROWS=50,
     superkingdom="all",
     cluster_samples=True,
     cluster_taxa=True):
+    """
+    Generates a heatmap from level_df, which holds only the rows of a single
+    taxonomic level (named by level, used for reporting). sample_cols is the
+    index of the sample columns, computed once by the caller.
+    """
 
-    # Sort for specified level and only viruses if specified
-    if superkingdom == "Virus":
-        rows = (df.superkingdom.isin(['sk__Viruses', 'Viruses']) & df.level.isin([level]))
-    elif superkingdom == "Bacteria":
-        rows = (df.superkingdom.isin(['sk__Bacteria', 'Bacteria']) & df.level.isin([level]))
+    # Only keep viruses or bacteria if specified
+    if superkingdom in SUPERKINGDOM_LABELS:
+        df = level_df[level_df.superkingdom.isin(SUPERKINGDOM_LABELS[superkingdom])]
     elif superkingdom == "all":
-        rows = (df.level.isin([level]))
+        df = level_df
     else:
         raise ValueError("Superkingdom value must be 'Virus', 'Bacteria', or 'all'." +
         " You entered {}".format(superkingdom))
 
-    df = df[rows]
-
-    # Get sample cols
-    sample_cols = [colname for colname in df.columns.to_list() if colname not in non_sample_cols]
+    # Pull the sample counts out once as a float32 matrix; everything up to the
+    # plot works on this rather than on the DataFrame
+    mat = np.ascontiguousarray(df[sample_cols].to_numpy(dtype=np.float32, copy=False))
 
-    # Take the top rows by mean
-    df['agg_mean'] = df[sample_cols].mean(axis=1)
-    df = df.sort_values('agg_mean', ascending = False).head(TOP_NUMBER_OF_ROWS)
-    df = df.drop(labels=['agg_mean'], axis=1)
+    # Take the top rows by mean, condense the numbers by taking log10 of
+    # everything, and remove columns that only have 0s
+    k = min(TOP_NUMBER_OF_ROWS, mat.shape[0])
+    top_idx, logged, keep = top_log10(mat, k)
+    logged = logged[:, keep]
+    sample_cols = sample_cols[keep]
 
-    # Condense the numbers by taking log2 of everything, and replace
-    # negative infinity with 0
-    df[sample_cols] = df[sample_cols].apply(np.log10).replace(np.NINF, 0)
-
-    # Remove columns that only have 0s
-    df = df.loc[:, (df != 0).any(axis=0)]
-
-    # Need to find the sample_cols again, because some removed
-    sample_cols = [col for col in sample_cols if col in df.columns.to_list()]
+    # Build the plotted frame in one go from the kept block, without copying
+    # it again. The superkingdom of each kept taxa travels alongside for the
+    # row colors; only the top rows' labels are taken from the categorical.
+    taxa = df.index[top_idx]
+    superkingdoms = pd.Series(np.asarray(df.superkingdom.array.take(top_idx), dtype=str),
+                              index=taxa)
+    df = pd.DataFrame(logged, index=taxa, columns=sample_cols, copy=False)
 
     # If DF is empty, i.e. no taxa met the conditions, return a notice.
     if len(df) == 0:
-        print("The dataframe is of size zero.")
-        print("There may be no taxa of the superkingdom, or no taxa of the given level.")
-        print("level: {0}, superkingdom:{1}".format(level, superkingdom))
+        print_empty_notice(level, superkingdom)
         return ''
 
     # If DF is only one row, can't do clustermap, do regular heatmap
     if len(df) == 1:
         print("There is only one taxa. Reporting a heatmap.")
-        heatmap = sns.heatmap(df[sample_cols],
+        # Draw on a new figure rather than whatever figure is current
+        _, ax = plt.subplots()
+        heatmap = sns.heatmap(df,
             cmap="Blues",
-            yticklabels=True
+            yticklabels=True,
+            ax=ax
         )
         return heatmap
 
     # Get a color palette to map to superkingdom status
-    network_pal = sns.color_palette('coolwarm', len(df.superkingdom.unique()))
-    network_lut = dict(zip(df.superkingdom.unique(), network_pal))
-    networks = df.superkingdom
-    network_colors = pd.Series(networks).map(network_lut)
+    network_pal = sns.color_palette('coolwarm', len(superkingdoms.unique()))
+    network_lut = dict(zip(superkingdoms.unique(), network_pal))
+    network_colors = superkingdoms.map(network_lut)
+
+    # Precompute the linkages
+    row_linkage = compute_linkage(logged) if cluster_taxa else None
+    col_linkage = compute_linkage(logged.T) if cluster_samples else None
 
     # Plot!
-    cluster_map = sns.clustermap(df[sample_cols],
+    cluster_map = sns.clustermap(df,
                    cmap="Blues",
                    cbar_kws={'label': 'Log10 Number of Reads'},
                    row_colors=network_colors,
                    yticklabels=True,
                    col_cluster=cluster_samples,
-                   row_cluster=cluster_taxa
+                   row_cluster=cluster_taxa,
+                   row_linkage=row_linkage,
+                   col_linkage=col_linkage
                    )
     plt.setp(cluster_map.ax_heatmap.yaxis.get_majorticklabels(), rotation=0)
     plt.setp(cluster_map.ax_heatmap.set_yticklabels(cluster_map.ax_heatmap.get_ymajorticklabels(), fontsize = 8))
@@ -108,6 +231,38 @@ def save_heatmap(heatmap, output_path):
         except AttributeError:
             heatmap.get_figure().savefig(output_path)
 
+def save_and_close_heatmap(heatmap, output_path):
+    """
+    Saves the heatmap, then closes its figure so figures don't pile up when
+    several heatmaps are drawn in one process.
+    """
+    save_heatmap(heatmap, output_path)
+    if heatmap != '':
+        try:
+            figure = heatmap.fig
+        except AttributeError:
+            figure = heatmap.get_figure()
+        plt.close(figure)
+    return output_path
+
+def available_cpus():
+    """
+    Number of CPUs this process may run on. Respects CPU affinity (e.g. a
+    cluster scheduler's allocation) where the platform reports it.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def heatmap_job(output_path, heatmap_args):
+    """
+    Generates and saves a single heatmap, heatmap_args being the positional
+    arguments to generate_heatmap. Run in a worker process, so the figure is
+    written there and only the output path is sent back.
+    """
+    return save_and_close_heatmap(generate_heatmap(*heatmap_args), output_path)
+
 def main():
     #---------------------------------------------------------------------------#
     # Parse inputs
@@ -186,6 +341,30 @@ def main():
         t, and similar iterations of False are acceptable inputs.
         ''',
     )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        required=False,
+        default=None,
+        help='''
+        Number of worker processes used to generate the heatmaps. Defaults to
+        one per heatmap, up to the number of CPUs. 1 runs them serially.
+        ''',
+    )
+    parser.add_argument(
+        "-k",
+        "--cache_dir",
+        type=str,
+        required=False,
+        default=None,
+        help='''
+        Directory to cache the parsed hit table in, as parquet (needs pyarrow).
+        Reruns on the same, unchanged input with the same format and suffix
+        load the cache instead of parsing the table again. No caching if
+        not given.
+        ''',
+    )
 
 
     args = parser.parse_args()
@@ -197,6 +376,8 @@ def main():
     output_format = args.output_format
     cluster_samples=args.cluster_samples
     cluster_taxa=args.cluster_taxa
+    processes=args.processes
+    cache_dir=args.cache_dir
 
     #------------------------------------------------------------------------------#
     # Setting defaults
@@ -224,93 +405,103 @@ def main():
     index_col = taxon
     non_sample_cols.remove(index_col)
 
-    # import data
-    print("Importing data.")
-    df = pd.read_csv(input_df, sep="\t", index_col = False).set_index(index_col)
+    # Look for a cached copy of the parsed table
+    cache_path = None
+    if cache_dir is not None:
+        if pa is None:
+            print("pyarrow is not installed, the parsed table will not be cached.")
+        else:
+            cache_path = hit_table_cache_path(cache_dir, input_df, input_format, remove_suffix)
+
+    if cache_path is not None and os.path.exists(cache_path):
+        print("Importing data from cache {0}".format(cache_path))
+        df = pd.read_parquet(cache_path, engine='pyarrow')
+    else:
+        # import data
+        print("Importing data.")
+        df = read_hit_table(input_df, index_col, [level, superkingdom], non_sample_cols)
 
-    # Remove suffix's if necessary
-    df.columns = [column.replace(remove_suffix, "") for column in df.columns.to_list()]
+        # Remove suffix's if necessary. Only a trailing match is removed.
+        if remove_suffix:
+            df.columns = df.columns.str.replace(re.escape(remove_suffix) + "$", "", regex=True)
 
-    # if format is pathseq, rename 'kingdom' to 'superkingdom' and 'type' to 'level'
-    if input_format == "pathseq":
-        df = df.rename({'kingdom':'superkingdom', 'type':'level'}, axis='columns')
+        # if format is pathseq, rename 'kingdom' to 'superkingdom' and 'type' to 'level'
+        if input_format.lower() == "pathseq":
+            df = df.rename({'kingdom':'superkingdom', 'type':'level'}, axis='columns')
+
+        if cache_path is not None:
+            # Write to a temporary file and move it into place, so a killed or
+            # concurrent run never leaves a truncated cache behind
+            pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".parquet.tmp")
+            os.close(fd)
+            try:
+                df.to_parquet(tmp_path, engine='pyarrow', compression='zstd')
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    if input_format.lower() == "pathseq":
         non_sample_cols = ['superkingdom' if item == 'kingdom' else item for item in non_sample_cols]
         non_sample_cols = ['level' if item == 'type' else item for item in non_sample_cols]
 
-    # generate heatmaps
-    print("Generating heatmaps.")
-    heatmap_viral_genera = generate_heatmap(df,
-                                'genus',
-                                non_sample_cols,
-                                TOP_NUMBER_OF_ROWS=TOP_NUMBER_OF_ROWS,
-                                superkingdom="Virus",
-                                cluster_samples=cluster_samples,
-                                cluster_taxa=cluster_taxa
-                                )
-    heatmap_viral_species = generate_heatmap(df,
-                                'species',
-                                non_sample_cols,
-                                TOP_NUMBER_OF_ROWS=TOP_NUMBER_OF_ROWS,
-                                superkingdom="Virus",
-                                cluster_samples=cluster_samples,
-                                cluster_taxa=cluster_taxa
-                                )
-    heatmap_viral_family = generate_heatmap(df,
-                                'family',
-                                non_sample_cols,
-                                TOP_NUMBER_OF_ROWS=TOP_NUMBER_OF_ROWS,
-                                superkingdom="Virus",
-                                cluster_samples=cluster_samples,
-                                cluster_taxa=cluster_taxa
-                                )
-
-    heatmap_bacteria_genera = generate_heatmap(df,
-                                'genus',
-                                non_sample_cols,
-                                TOP_NUMBER_OF_ROWS=TOP_NUMBER_OF_ROWS,
-                                superkingdom="Bacteria",
-                                cluster_samples=cluster_samples,
-                                cluster_taxa=cluster_taxa
-                                )
-    heatmap_bacteria_species = generate_heatmap(df,
-                                'species',
-                                non_sample_cols,
-                                TOP_NUMBER_OF_ROWS=TOP_NUMBER_OF_ROWS,
-                                superkingdom="Bacteria",
-                                cluster_samples=cluster_samples,
-                                cluster_taxa=cluster_taxa
-                                )
-
-    heatmap_all_genera = generate_heatmap(df,
-                            'genus',
-                            non_sample_cols,
-                            TOP_NUMBER_OF_ROWS=TOP_NUMBER_OF_ROWS,
-                            superkingdom="all",
-                            cluster_samples=cluster_samples,
-                            cluster_taxa=cluster_taxa
-                            )
-    heatmap_all_species = generate_heatmap(df,
-                            'species',
-                            non_sample_cols,
-                            TOP_NUMBER_OF_ROWS=TOP_NUMBER_OF_ROWS,
-                            superkingdom="all",
-                            cluster_samples=cluster_samples,
-                            cluster_taxa=cluster_taxa
-                            )
+    # Split the table by level once; every heatmap works from these subframes
+    sample_cols = df.columns[~df.columns.isin(frozenset(non_sample_cols))]
+    level_frames = {lvl: sub for lvl, sub in df.groupby('level', sort=False, observed=True)}
+    empty_frame = df.iloc[0:0]
 
     # Make output dir if needed
     output_directory = os.path.dirname(output_prefix)
     pathlib.Path(output_directory).mkdir(parents=True, exist_ok=True)
 
-    # Write heatmaps to output
-    print("Writing heatmaps.")
-    save_heatmap(heatmap_viral_genera, output_prefix + "_viral_genera." + output_format)
-    save_heatmap(heatmap_viral_species, output_prefix + "_viral_species." + output_format)
-    save_heatmap(heatmap_viral_family, output_prefix + "_viral_family." + output_format)
-    save_heatmap(heatmap_bacteria_genera, output_prefix + "_bacterial_genera." + output_format)
-    save_heatmap(heatmap_bacteria_species, output_prefix + "_bacterial_species." + output_format)
-    save_heatmap(heatmap_all_genera, output_prefix + "_all_genera." + output_format)
-    save_heatmap(heatmap_all_species, output_prefix + "_all_species." + output_format)
+    # (output name, level, superkingdom) for each heatmap
+    heatmaps = [
+        ("viral_genera", 'genus', "Virus"),
+        ("viral_species", 'species', "Virus"),
+        ("viral_family", 'family', "Virus"),
+        ("bacterial_genera", 'genus', "Bacteria"),
+        ("bacterial_species", 'species', "Bacteria"),
+        ("all_genera", 'genus', "all"),
+        ("all_species", 'species', "all"),
+    ]
+
+    # Count the taxa behind each heatmap up front from the group sizes, so
+    # heatmaps with no taxa are skipped rather than sent to a worker
+    taxa_counts = df.groupby(['superkingdom', 'level'], observed=True).size()
+    jobs = []
+    for name, heatmap_level, heatmap_superkingdom in heatmaps:
+        level_df = level_frames.get(heatmap_level, empty_frame)
+        if heatmap_superkingdom == "all":
+            n_taxa = len(level_df)
+        else:
+            n_taxa = sum(taxa_counts.get((label, heatmap_level), 0)
+                         for label in SUPERKINGDOM_LABELS[heatmap_superkingdom])
+        if n_taxa == 0:
+            print_empty_notice(heatmap_level, heatmap_superkingdom)
+            continue
+        jobs.append((output_prefix + "_" + name + "." + output_format,
+                     (level_df,
+                      sample_cols,
+                      heatmap_level,
+                      TOP_NUMBER_OF_ROWS,
+                      heatmap_superkingdom,
+                      cluster_samples,
+                      cluster_taxa)))
+
+    # Generate and write heatmaps. They are independent of each other, so each
+    # one is built in its own process, which only receives its level's rows.
+    print("Generating and writing heatmaps.")
+    if processes is None:
+        processes = min(len(jobs), available_cpus())
+    if processes <= 1:
+        for job in jobs:
+            heatmap_job(*job)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(heatmap_job, *job) for job in jobs]
+            for future in as_completed(futures):
+                print("Finished {0}".format(future.result()))
 
     print("Finished.")
 